@@ -1,28 +1,134 @@
-from collections import defaultdict
 import event_model
 import json
 import numpy
 from pathlib import Path
 import suitcase.utils
+import sys
 from ._version import get_versions
 
+try:
+    import dask.array
+except ImportError:
+    dask = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 __version__ = get_versions()['version']
 del get_versions
 
 
+# Maps the most common numpy types directly to the (unbound) method which
+# converts them to built-in python objects.
+_NUMPY_DISPATCH = {t: t.item for t in (
+    numpy.bool_, numpy.int8, numpy.int16, numpy.int32, numpy.int64,
+    numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64,
+    numpy.float16, numpy.float32, numpy.float64, numpy.str_)}
+_NUMPY_DISPATCH[numpy.ndarray] = numpy.ndarray.tolist
+
+
 class NumpyEncoder(json.JSONEncoder):
     # Credit: https://stackoverflow.com/a/47626762/1221924
     def default(self, obj):
-        if isinstance(obj, (numpy.generic, numpy.ndarray)):
-            if numpy.isscalar(obj):
-                return obj.item()
-            return obj.tolist()
-        return json.JSONEncoder.default(self, obj)
+        try:
+            return _numpy_default(obj)
+        except TypeError:
+            return json.JSONEncoder.default(self, obj)
+
+
+def _numpy_default(obj):
+    # Converts the objects event_model.NumpyEncoder handles (numpy and dask
+    # arrays) to built-in python objects. Also used directly by orjson, for
+    # which it additionally turns tuple subclasses (e.g. namedtuples) into
+    # lists, as the standard library does.
+    conv = _NUMPY_DISPATCH.get(type(obj))
+    if conv is not None:
+        return conv(obj)
+    if dask is not None and isinstance(obj, dask.array.Array):
+        obj = numpy.asarray(obj)
+    if isinstance(obj, numpy.generic):
+        return obj.item()
+    if isinstance(obj, numpy.ndarray):
+        return obj.tolist()
+    if isinstance(obj, tuple):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON "
+                    f"serializable")
+
+
+def _contains_numpy(doc):
+    '''Return True if any value nested in ``doc`` is a numpy (or dask) object.
+
+    These are the objects event_model.NumpyEncoder converts, and hence those
+    sanitize_doc takes care of.
+    '''
+    stack = [doc]
+    while stack:
+        obj = stack.pop()
+        # subclasses matter: ophyd's describe_configuration gives OrderedDicts
+        if isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, (numpy.generic, numpy.ndarray)):
+            return True
+        elif dask is not None and isinstance(obj, dask.array.Array):
+            return True
+    return False
+
+
+def _compact_descriptors(descriptors):
+    '''Return ``descriptors`` with the top-level keys shared by documents
+    stored once.
+
+    Each stream maps to a list of ``{'_keys': keys, '_rows': rows}`` groups,
+    one per distinct set of descriptor keys, where ``keys`` is sorted and each
+    row holds the values of one descriptor in that order. Nested contents,
+    such as ``data_keys`` and ``configuration``, are left as they are.
+    '''
+    compacted = {}
+    for stream_name, docs in descriptors.items():
+        groups = {}
+        for doc in docs.values():
+            keys = tuple(sorted(doc))
+            groups.setdefault(keys, []).append([doc[key] for key in keys])
+        compacted[stream_name] = [{'_keys': list(keys), '_rows': rows}
+                                  for keys, rows in groups.items()]
+    return compacted
+
+
+def _orjson_option(cls, kwargs):
+    '''Return the orjson option flags equivalent to ``json.dump(**kwargs)``.
+
+    Returns None if orjson cannot reproduce ``cls`` and ``kwargs``, in which
+    case the standard library should be used.
+    '''
+    if cls is not event_model.NumpyEncoder:
+        return None
+    kwargs = dict(kwargs)
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    if kwargs.pop('sort_keys', False):
+        option |= orjson.OPT_SORT_KEYS
+    indent = kwargs.pop('indent', None)
+    separators = kwargs.pop('separators', None)
+    if indent is None:
+        if separators not in (None, (',', ':')):
+            return None
+    elif indent == 2 and separators in (None, (',', ': ')):
+        option |= orjson.OPT_INDENT_2
+    else:
+        return None
+    if kwargs:
+        return None
+    return option
 
 
 def export(gen, directory, file_prefix='{start[uid]}-',
-           cls=event_model.NumpyEncoder, **kwargs):
+           cls=event_model.NumpyEncoder, encoder='json', compact=False,
+           **kwargs):
     """
     Export the meta data from a stream of documents to a JSON file.
 
@@ -68,6 +174,22 @@ def export(gen, directory, file_prefix='{start[uid]}-',
         correctly. The defualt is ``event_model.NumpyEncoder`` which also
         ensures that all ``numpy`` objects are converted to built-in python
         ones.
+    encoder : {'json', 'orjson'}, optional
+        The library used to encode the JSON. The default, ``'json'``, uses
+        the standard library. ``'orjson'`` uses the (optional) ``orjson``
+        package, which is considerably faster on large metadata. It is only
+        used when ``cls`` is left at its default and the ``json.dump`` kwargs
+        are limited to ``sort_keys`` and ``indent=2``; otherwise, or if orjson
+        cannot encode the metadata (e.g. integers beyond 64 bits), the
+        standard library is used instead. Note that orjson writes NaN and
+        infinity as ``null``.
+    compact : bool, optional
+        If True, the descriptors of each stream are written as a list of
+        ``{'_keys': [key1, ...], '_rows': [[value1, ...], ...]}`` groups, one
+        per distinct set of top-level descriptor keys (sorted), so that those
+        key names are written only once per stream. Only the top-level names
+        are deduplicated; repeated ``data_keys`` and ``configuration``
+        contents are written in full. Default is False.
     **kwargs : kwargs
         kwargs to be passed to ``json.dump``.
 
@@ -95,7 +217,8 @@ def export(gen, directory, file_prefix='{start[uid]}-',
 
     >>> export(gen, '/path/to/my_usb_stick')
     """
-    with Serializer(directory, file_prefix, cls=cls, **kwargs) as serializer:
+    with Serializer(directory, file_prefix, cls=cls, encoder=encoder,
+                    compact=compact, **kwargs) as serializer:
         for item in gen:
             serializer(*item)
 
@@ -145,6 +268,22 @@ class Serializer(event_model.DocumentRouter):
         correctly. The defualt is ``event_model.NumpyEncoder`` which also
         ensures that all ``numpy`` objects are converted to built-in python
         ones.
+    encoder : {'json', 'orjson'}, optional
+        The library used to encode the JSON. The default, ``'json'``, uses
+        the standard library. ``'orjson'`` uses the (optional) ``orjson``
+        package, which is considerably faster on large metadata. It is only
+        used when ``cls`` is left at its default and the ``json.dump`` kwargs
+        are limited to ``sort_keys`` and ``indent=2``; otherwise, or if orjson
+        cannot encode the metadata (e.g. integers beyond 64 bits), the
+        standard library is used instead. Note that orjson writes NaN and
+        infinity as ``null``.
+    compact : bool, optional
+        If True, the descriptors of each stream are written as a list of
+        ``{'_keys': [key1, ...], '_rows': [[value1, ...], ...]}`` groups, one
+        per distinct set of top-level descriptor keys (sorted), so that those
+        key names are written only once per stream. Only the top-level names
+        are deduplicated; repeated ``data_keys`` and ``configuration``
+        contents are written in full. Default is False.
     **kwargs : kwargs
         kwargs to be passed to ``json.dump``.
 
@@ -168,19 +307,36 @@ class Serializer(event_model.DocumentRouter):
     >>> export(gen, '/path/to/my_usb_stick')
     """
     def __init__(self, directory, file_prefix='{start[uid]}-',
-                 cls=event_model.NumpyEncoder, **kwargs):
+                 cls=event_model.NumpyEncoder, encoder='json', compact=False,
+                 **kwargs):
+
+        if encoder not in ('json', 'orjson'):
+            raise ValueError(
+                f"encoder must be 'json' or 'orjson', not {encoder!r}")
+        if encoder == 'orjson' and orjson is None:
+            raise ImportError(
+                "encoder='orjson' requires the orjson package to be installed")
 
         if isinstance(directory, (str, Path)):
             self._manager = suitcase.utils.MultiFileManager(directory)
         else:
             self._manager = directory
 
-        self._meta = defaultdict(dict)  # to be exported as JSON at the end
-        self._meta['metadata']['descriptors'] = defaultdict(lambda:
-                                                            defaultdict(dict))
+        # to be exported as JSON at the end
+        self._meta = {'metadata': {'descriptors': {}}}
+        self._descriptors = self._meta['metadata']['descriptors']
         self._file_prefix = file_prefix
         self._templated_file_prefix = ''
+        self._compact = compact
         self._kwargs = dict(cls=cls, **kwargs)
+        self._orjson_option = None
+        if encoder == 'orjson':
+            self._orjson_option = _orjson_option(cls, kwargs)
+        self._use_orjson = self._orjson_option is not None
+        # Both orjson and event_model.NumpyEncoder convert numpy objects while
+        # encoding, in which case descriptors need not be sanitized up front.
+        # (orjson is only used with the default cls)
+        self._encoder_handles_numpy = cls is event_model.NumpyEncoder
 
     @property
     def artifacts(self):
@@ -222,10 +378,29 @@ class Serializer(event_model.DocumentRouter):
         # add the stop doc to self._meta.
         self._meta['metadata']['stop'] = doc
 
-        # open a json file for the metadata and add self._meta to it.
+        meta = self._meta
+        if self._compact:
+            meta = {'metadata': {
+                **meta['metadata'],
+                'descriptors': _compact_descriptors(self._descriptors)}}
+
+        # encode the metadata, then open a json file and add it to it.
+        encoded = None
+        if self._use_orjson:
+            try:
+                encoded = orjson.dumps(meta, default=_numpy_default,
+                                       option=self._orjson_option)
+            except orjson.JSONEncodeError:
+                # e.g. integers beyond 64 bits, which the standard library
+                # can still encode
+                pass
+        if encoded is None:
+            # json.dump would issue one write per encoded chunk; encode in
+            # memory and write once instead.
+            encoded = json.dumps(meta, **self._kwargs).encode('utf-8')
         f = self._manager.open('run_metadata',
-                               f'{self._templated_file_prefix}meta.json', 'xt')
-        json.dump(self._meta, f, **self._kwargs)
+                               f'{self._templated_file_prefix}meta.json', 'xb')
+        f.write(encoded)
         self.close()
 
     def descriptor(self, doc):
@@ -240,12 +415,21 @@ class Serializer(event_model.DocumentRouter):
         '''
         # extract some useful info from the doc
         stream_name = doc.get('name')
-        # replace numpy objects with python ones to ensure json compatibility
-        sanitized_doc = event_model.sanitize_doc(doc)
+        if isinstance(stream_name, str):
+            # the same few stream names recur across descriptors and runs
+            stream_name = sys.intern(stream_name)
+        # replace numpy objects with python ones to ensure json compatibility,
+        # unless the encoder will take care of that itself or there are none,
+        # which is the common case and much cheaper to check than to sanitize
+        if self._encoder_handles_numpy or not _contains_numpy(doc):
+            # a shallow copy, so that top-level changes made to the document
+            # by other consumers before `stop` do not end up in the file
+            sanitized_doc = dict(doc)
+        else:
+            sanitized_doc = event_model.sanitize_doc(doc)
         # Add the doc to self._meta
-        self._meta['metadata'
-                   ]['descriptors'][stream_name][sanitized_doc['uid']
-                                                 ] = sanitized_doc
+        self._descriptors.setdefault(
+            stream_name, {})[sanitized_doc['uid']] = sanitized_doc
 
     def close(self):
         '''Close all of the files opened by this Serializer.
@@ -1,28 +1,63 @@
-from collections import defaultdict
+from collections import namedtuple, OrderedDict
 import event_model
-from .. import export
+from .. import (export, NumpyEncoder, Serializer, _compact_descriptors,
+                _numpy_default)
 import json
+import numpy
+from pathlib import Path
 import pytest
+import suitcase.utils
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    _loads = json.loads
+else:
+    _loads = orjson.loads
+
+
+_TOP_LEVEL_DOCS = frozenset(('start', 'stop'))
+Point = namedtuple('Point', ['x', 'y'])
 
 
 def create_expected(collector):
     '''This collects the metadata into a dict to compare to the loaded data
     '''
-    expected = {'metadata': {}}
-    expected['metadata']['descriptors'] = defaultdict(dict)
+    expected = {'metadata': {'descriptors': {}}}
+    metadata = expected['metadata']
+    descriptors = metadata['descriptors']
+    sanitize = event_model.sanitize_doc
     for name, doc in collector:
-        if name in ['start', 'stop']:
-            sanitized_doc = event_model.sanitize_doc(doc)
-            expected['metadata'][name] = sanitized_doc
+        if name in _TOP_LEVEL_DOCS:
+            metadata[name] = sanitize(doc)
         elif name == 'descriptor':
-            sanitized_doc = event_model.sanitize_doc(doc)
-            expected['metadata']['descriptors'
-                                 ][doc.get('name')][doc['uid']] = sanitized_doc
+            stream = descriptors.setdefault(doc['name'], {})
+            stream[doc['uid']] = sanitize(doc)
 
     return expected
 
 
-def test_export(tmp_path, example_data):
+@pytest.fixture(params=['disk', 'memory'])
+def directory(request, tmp_path):
+    '''Returns either a path on disk or a MemoryBuffersManager to export to.
+    '''
+    if request.param == 'memory':
+        return suitcase.utils.MemoryBuffersManager()
+    return tmp_path
+
+
+def read_exported(directory, artifacts):
+    '''Returns the content of each exported metadata file as bytes.
+    '''
+    if isinstance(directory, suitcase.utils.MemoryBuffersManager):
+        return [buffer.getvalue() for buffer in directory.buffers.values()]
+    return [Path(filename).read_bytes()
+            for filename in artifacts['run_metadata']]
+
+
+@pytest.mark.parametrize("encoder", ['json', 'orjson'])
+def test_export(directory, example_data, encoder):
     ''' runs a test using the plan that is passed through to it
 
     ..note::
@@ -32,21 +67,26 @@ def test_export(tmp_path, example_data):
         `suitcase.utils.conftest` for more info
 
     '''
+    if encoder == 'orjson':
+        pytest.importorskip('orjson')
 
     collector = example_data()
     expected = create_expected(collector)
-    artifacts = export(collector, tmp_path, file_prefix='')
+    artifacts = export(collector, directory, file_prefix='', encoder=encoder)
 
-    for filename in artifacts['run_metadata']:
-        with open(filename) as f:
-            actual = json.load(f)
+    contents = read_exported(directory, artifacts)
+    assert len(contents) == 1
+    for content in contents:
+        actual = _loads(content)
         assert actual == expected
 
 
 @pytest.mark.parametrize("kwargs", [{'indent': 4},
                                     {'sort_keys': True, 'indent': 2,
-                                     'separators': (',', ': ')}])
-def test_export_with_kwargs(tmp_path, example_data, kwargs):
+                                     'separators': (',', ': ')}],
+                         ids=['indent4', 'pretty'])
+@pytest.mark.parametrize("encoder", ['json', 'orjson'])
+def test_export_with_kwargs(tmp_path, example_data, kwargs, encoder):
     ''' runs a test using the plan that is passed through to it
 
     ..note::
@@ -56,22 +96,238 @@ def test_export_with_kwargs(tmp_path, example_data, kwargs):
         `suitcase.utils.conftest` for more info
 
     '''
+    if encoder == 'orjson':
+        pytest.importorskip('orjson')
 
     collector = example_data()
     expected = create_expected(collector)
-    artifacts = export(collector, tmp_path, file_prefix='', **kwargs)
+    artifacts = export(collector, tmp_path, file_prefix='', encoder=encoder,
+                       **kwargs)
 
+    n = 20
+    first_n_simbols = ('{\n' + ' ' * kwargs['indent'] +
+                       '"metadata": {\n' + ' ' * kwargs['indent'])[:n].encode()
     for filename in artifacts['run_metadata']:
-        with open(filename) as f:
-            content = f.read()
-            actual = json.loads(content)
-        n = 20
-        first_n_simbols = ('{\n' + ' ' * kwargs['indent'] +
-                           '"metadata": {\n' + ' ' * kwargs['indent'])[:n]
+        content = Path(filename).read_bytes()
+        actual = _loads(content)
         assert content[:n] == first_n_simbols
         assert actual == expected
 
 
+def expand_descriptors(descriptors):
+    '''Inverts the ``compact=True`` layout of the exported descriptors.
+    '''
+    expanded = {}
+    for stream_name, groups in descriptors.items():
+        docs = expanded.setdefault(stream_name, {})
+        for group in groups:
+            for row in group['_rows']:
+                doc = dict(zip(group['_keys'], row))
+                docs[doc['uid']] = doc
+    return expanded
+
+
+@pytest.mark.parametrize("encoder", ['json', 'orjson'])
+def test_export_compact(tmp_path, example_data, encoder):
+    ''' runs a test of the ``compact`` descriptor layout, which should round
+    trip to the same metadata as the default layout.
+    '''
+    if encoder == 'orjson':
+        pytest.importorskip('orjson')
+
+    collector = example_data()
+    expected = create_expected(collector)
+    artifacts = export(collector, tmp_path, file_prefix='', encoder=encoder,
+                       compact=True)
+
+    for filename in artifacts['run_metadata']:
+        actual = _loads(Path(filename).read_bytes())
+        for groups in actual['metadata']['descriptors'].values():
+            for group in groups:
+                assert set(group) == {'_keys', '_rows'}
+        actual['metadata']['descriptors'] = expand_descriptors(
+            actual['metadata']['descriptors'])
+        assert actual == expected
+
+
+def test_compact_descriptors_with_reordered_keys():
+    ''' checks that descriptors with the same keys in a different order share
+    one group.
+    '''
+    descriptors = {'primary': {'a': {'uid': 'a', 'x': 1},
+                               'b': {'x': 2, 'uid': 'b'}}}
+    compacted = _compact_descriptors(descriptors)
+    assert compacted == {'primary': [{'_keys': ['uid', 'x'],
+                                      '_rows': [['a', 1], ['b', 2]]}]}
+    assert expand_descriptors(compacted) == descriptors
+
+
+def test_export_with_custom_cls(tmp_path, example_data):
+    ''' runs a test with a ``cls`` that does not handle numpy objects, which
+    requires the descriptors to be sanitized before encoding.
+    '''
+
+    class PlainEncoder(json.JSONEncoder):
+        ...
+
+    collector = example_data()
+    expected = create_expected(collector)
+    artifacts = export(collector, tmp_path, file_prefix='', cls=PlainEncoder)
+
+    for filename in artifacts['run_metadata']:
+        actual = _loads(Path(filename).read_bytes())
+        assert actual == expected
+
+
+def export_descriptor(configuration, mutate=None, **kwargs):
+    '''Exports a run with one descriptor carrying ``configuration`` and
+    returns the exported metadata together with the expected metadata.
+
+    ``mutate``, if given, is called with the descriptor document right after
+    the Serializer has received it.
+    '''
+    run_bundle = event_model.compose_run()
+    desc_bundle = run_bundle.compose_descriptor(
+        name='primary',
+        data_keys={'x': {'source': 'sim', 'dtype': 'number', 'shape': []}},
+        configuration=configuration)
+    stop_doc = run_bundle.compose_stop()
+    expected = create_expected([('start', run_bundle.start_doc),
+                                ('descriptor', desc_bundle.descriptor_doc),
+                                ('stop', stop_doc)])
+
+    manager = suitcase.utils.MemoryBuffersManager()
+    with Serializer(manager, **kwargs) as serializer:
+        serializer('start', run_bundle.start_doc)
+        serializer('descriptor', desc_bundle.descriptor_doc)
+        if mutate is not None:
+            mutate(desc_bundle.descriptor_doc)
+        serializer('stop', stop_doc)
+    buffer, = manager.buffers.values()
+    return _loads(buffer.getvalue()), expected
+
+
+@pytest.mark.parametrize("value", ['numpy', 'dask'])
+@pytest.mark.parametrize("mapping", [dict, OrderedDict])
+def test_descriptor_with_numpy_and_custom_cls(mapping, value):
+    ''' checks that numpy objects (and dask arrays) in a descriptor are
+    sanitized when ``cls`` does not handle them, including inside the
+    OrderedDicts ophyd returns.
+    '''
+    if value == 'dask':
+        dask_array = pytest.importorskip('dask.array')
+        obj = dask_array.from_array(numpy.arange(4), chunks=2)
+    else:
+        obj = numpy.int64(2)
+
+    configuration = {'det': {'data': mapping(gain=obj),
+                             'timestamps': mapping(gain=1.),
+                             'data_keys': {}}}
+    actual, expected = export_descriptor(configuration, cls=json.JSONEncoder)
+    assert actual == expected
+
+
+@pytest.mark.parametrize("value", ['namedtuple', 'dask'])
+@pytest.mark.parametrize("encoder", ['json', 'orjson'])
+def test_descriptor_with_non_numpy_values(encoder, value):
+    ''' checks that descriptors holding objects which sanitize_doc would have
+    converted are still exported correctly without being sanitized.
+    '''
+    if encoder == 'orjson':
+        pytest.importorskip('orjson')
+    if value == 'dask':
+        dask_array = pytest.importorskip('dask.array')
+        obj = dask_array.from_array(numpy.arange(4), chunks=2)
+    else:
+        obj = Point(1, numpy.int64(2))
+
+    configuration = {'det': {'data': {'offsets': obj},
+                             'timestamps': {'offsets': 1.},
+                             'data_keys': {}}}
+    actual, expected = export_descriptor(configuration, encoder=encoder)
+    assert actual == expected
+
+
+@pytest.mark.parametrize("encoder", ['json', 'orjson'])
+def test_descriptor_mutated_after_export(encoder):
+    ''' checks that later top-level changes to a descriptor by another
+    consumer do not leak into the exported metadata.
+    '''
+    if encoder == 'orjson':
+        pytest.importorskip('orjson')
+
+    def mutate(doc):
+        doc['hints'] = {'det': {'fields': ['changed']}}
+
+    actual, expected = export_descriptor({}, mutate=mutate, encoder=encoder)
+    assert actual == expected
+
+
+def export_start_metadata(metadata, **kwargs):
+    '''Exports a run whose start document carries ``metadata`` and returns
+    the exported bytes.
+    '''
+    run_bundle = event_model.compose_run(metadata=metadata)
+    manager = suitcase.utils.MemoryBuffersManager()
+    with Serializer(manager, **kwargs) as serializer:
+        serializer('start', run_bundle.start_doc)
+        serializer('stop', run_bundle.compose_stop())
+    buffer, = manager.buffers.values()
+    return buffer.getvalue()
+
+
+def test_default_encoder_is_stdlib():
+    ''' checks that the default export writes user metadata exactly as the
+    standard library does, whether or not orjson is installed.
+    '''
+    metadata = {'big': 2 ** 70, 'point': Point(1, 2),
+                'nan': float('nan'), 'inf': float('inf')}
+    content = export_start_metadata(metadata)
+    start = json.loads(content)['metadata']['start']
+    assert start['big'] == 2 ** 70
+    assert start['point'] == [1, 2]
+    assert b'"nan": NaN' in content
+    assert b'"inf": Infinity' in content
+
+
+@pytest.mark.parametrize("metadata, expected",
+                         [({'big': 2 ** 70}, {'big': 2 ** 70}),
+                          ({'point': Point(1, 2)}, {'point': [1, 2]})])
+def test_orjson_encoder_with_unusual_metadata(metadata, expected):
+    ''' checks that orjson either encodes the metadata or falls back to the
+    standard library when it cannot.
+    '''
+    pytest.importorskip('orjson')
+    content = export_start_metadata(metadata, encoder='orjson')
+    start = json.loads(content)['metadata']['start']
+    for key, value in expected.items():
+        assert start[key] == value
+
+
+def test_no_file_without_stop():
+    ''' checks that a run which never sends a `stop` document leaves no (empty)
+    metadata file behind.
+    '''
+    run_bundle = event_model.compose_run()
+    manager = suitcase.utils.MemoryBuffersManager()
+    with Serializer(manager) as serializer:
+        serializer('start', run_bundle.start_doc)
+    assert not manager.buffers
+    assert not serializer.artifacts
+
+
+def test_stop_without_start():
+    ''' checks that a `stop` document is still exported without a `start`.
+    '''
+    run_bundle = event_model.compose_run()
+    stop_doc = run_bundle.compose_stop()
+    manager = suitcase.utils.MemoryBuffersManager()
+    with Serializer(manager, file_prefix='') as serializer:
+        serializer('stop', stop_doc)
+    buffer, = manager.buffers.values()
+    assert _loads(buffer.getvalue()) == create_expected([('stop', stop_doc)])
+
+
 def test_file_prefix_formatting(file_prefix_list, example_data, tmp_path):
     '''Runs a test of the ``file_prefix`` formatting.
     ..note::
@@ -93,3 +349,49 @@ def test_file_prefix_formatting(file_prefix_list, example_data, tmp_path):
         unique_actual = set(str(artifact).split('/')[-1].partition('-')[0]
                             for artifact in artifacts['run_metadata'])
         assert unique_actual == set([templated_file_prefix])
+
+
+@pytest.mark.parametrize("obj, expected",
+                         [(numpy.int64(3), 3), (numpy.float32(0.5), 0.5),
+                          (numpy.bool_(True), True), (numpy.str_('a'), 'a'),
+                          (numpy.intc(2), 2), (numpy.array(7), 7),
+                          (numpy.arange(6).reshape(2, 3)[:, ::2],
+                           [[0, 2], [3, 5]])])
+def test_numpy_encoder(obj, expected):
+    ''' checks that NumpyEncoder converts numpy objects to built-in ones.
+    '''
+    assert json.loads(json.dumps({'x': obj}, cls=NumpyEncoder)) == {
+        'x': expected}
+
+
+def test_numpy_encoder_dask():
+    ''' checks that NumpyEncoder converts dask arrays, as event_model does.
+    '''
+    dask_array = pytest.importorskip('dask.array')
+    obj = dask_array.from_array(numpy.arange(4), chunks=2)
+    assert json.loads(json.dumps({'x': obj}, cls=NumpyEncoder)) == {
+        'x': [0, 1, 2, 3]}
+
+
+@pytest.mark.parametrize("obj, expected",
+                         [(numpy.int64(3), 3), (numpy.intc(2), 2),
+                          (numpy.arange(6).reshape(2, 3)[:, ::2],
+                           [[0, 2], [3, 5]]),
+                          (Point(1, numpy.int64(2)), [1, 2])])
+def test_numpy_default_with_orjson(obj, expected):
+    ''' checks the conversions orjson falls back to ``_numpy_default`` for.
+    '''
+    pytest.importorskip('orjson')
+    assert orjson.loads(orjson.dumps(
+        {'x': obj}, default=_numpy_default,
+        option=orjson.OPT_SERIALIZE_NUMPY)) == {'x': expected}
+
+
+def test_numpy_default_with_orjson_dask():
+    ''' checks that ``_numpy_default`` converts dask arrays for orjson.
+    '''
+    pytest.importorskip('orjson')
+    dask_array = pytest.importorskip('dask.array')
+    obj = dask_array.from_array(numpy.arange(4), chunks=2)
+    assert orjson.loads(orjson.dumps({'x': obj}, default=_numpy_default)) == {
+        'x': [0, 1, 2, 3]}